@@ -6,11 +6,43 @@ import base64
 import time
 import subprocess
 import re
-from datetime import datetime, timedelta
-from pymsgbox import prompt
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from litellm import completion
+import json
+import functools
+import secrets
+import signal
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used without it
+    orjson = None
+
+if orjson is not None:
+    _stdlib_json_dumps = json.dumps
+
+    def _orjson_dumps(obj, **kwargs):
+        """json.dumps stand-in that serialises with orjson when called with default options."""
+        if kwargs:
+            return _stdlib_json_dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # e.g. non-str dict keys or ints beyond 64 bits
+            return _stdlib_json_dumps(obj)
+
+    # Request bodies (including large base64 media) are serialised by httpx, litellm and
+    # python-telegram-bot via json.dumps; patch before importing them since httpx binds it at import
+    json.dumps = _orjson_dumps
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, Update
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+import httpx
+import litellm
+from litellm import acompletion
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler
 from PIL import Image
 import requests
 from dotenv import load_dotenv
@@ -20,140 +52,499 @@ load_dotenv(override=True)
 
 # Configure logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(logging.DEBUG if os.getenv("SAARAA_DEBUG") else logging.INFO)
 logger.addHandler(logging.StreamHandler())
+
+# Defaults for every litellm call: never wait on Gemini indefinitely, retry transient failures twice
+litellm.request_timeout = 30
+litellm.num_retries = 2
+
+# Friendly replies for Gemini being slow or saturated
+_GEMINI_TIMEOUT_REPLY = "Gemini is taking too long right now, கண்ணே. Try again in a bit? ⏳"
+_GEMINI_RATE_LIMIT_REPLY = "Too many people talking to me at once! Give me a minute and try again. 🙏"
+
+# Largest media payload we download and forward to Gemini
+MAX_MEDIA_BYTES = 5 * 1024 * 1024
+
+# Bump whenever the prompts change so cached media replies from older prompts are ignored
+PROMPT_VERSION = 2
+
+# Personality shared by every request; kept byte-identical so Gemini can reuse its cached prefix.
+# Per-user details go in a separate message (see SaaraaBot.build_messages).
+_SAARAA_SYSTEM_PROMPT = (
+    "You're சாரா 👸. Based on the user's name, detect their likely gender and adapt your personality: "
+    "If male, act like a sweet girlfriend (call them 'honey', 'baby', 'kutty' - be loving and affectionate). "
+    "If female, act like a supportive sister (call them 'akka' - be warm and sisterly). If unsure, be friendly. "
+    "Respond in Kongu Colloquial Tamil mixed with English. Follow KISS principle - Keep It Simple, Stupid! "
+    "Be direct and useful. Consider our conversation context if relevant."
+)
+
+# Per-turn instructions for each kind of content
+_IMAGE_INSTRUCTION = (
+    "PRIORITY: If there are commands/code in the image, extract the ACTUAL EXECUTABLE COMMANDS using markdown (```bash). "
+    "Don't describe - give the commands directly so they can copy-paste them."
+)
+_TEXT_INSTRUCTION = "Respond in EXACTLY ONE LINE ONLY. If there are commands/code, extract them using markdown (```)."
+# Turn templates joined once here, so each turn is a single concat with the user's content
+_IMAGE_TURN_TEXT = _IMAGE_INSTRUCTION + " Analyze this image."
+_AUDIO_TURN_TEXT = _TEXT_INSTRUCTION + " Listen to this audio and transcribe"
+_TRANSCRIPT_TURN_PREFIX = _TEXT_INSTRUCTION + " Transcribed audio: "
+_TEXT_TURN_PREFIX = _TEXT_INSTRUCTION + " Message: "
+
+# Max concurrent Gemini requests; the default stays within the free-tier Google AI concurrency
+GEMINI_MAX_INFLIGHT = int(os.getenv("LLM_INFLIGHT_LIMIT", "8"))
+
+# Opt-in: answer first messages from different chats in one shared Gemini prompt.
+# Those users' texts then sit side by side, so one can steer another's answer; off by default.
+TEXT_BATCHING = bool(os.getenv("LLM_TEXT_BATCHING"))
+
+# Code blocks with optional language specifier; handles both newline and
+# non-newline cases after the language
+_CODE_BLOCK_RE = re.compile(r'```(?:(\w+)\s*)?(.*?)```', re.DOTALL)
+
+# Commands we refuse to execute, joined so one scan checks them all
+_DANGEROUS_RE = re.compile('|'.join([
+    r'rm\s+-rf',
+    r'sudo',
+    r'chmod\s+777',
+    r'>/dev/null',
+    r'&\s*$',
+    r'shutdown',
+    r'reboot',
+    r'format',
+    r'mkfs',
+    r'dd\s+if=',
+    r'curl.*\|.*bash',
+    r'wget.*\|.*bash'
+]), re.IGNORECASE)
+
+# Interpreters started ahead of time that read one code block from stdin and run it, so
+# executing a block skips interpreter start-up; each process still runs a single block
+# Runs the block read from stdin; on error it prints the traceback without this driver's own
+# frame, so output (and the exit status) match running the block with python -c
+_PYTHON_DRIVER = (
+    "import sys, traceback\n"
+    "try:\n"
+    "    exec(compile(sys.stdin.read(), '<string>', 'exec'), {'__name__': '__main__'})\n"
+    "except SystemExit:\n"
+    "    raise\n"
+    "except BaseException as e:\n"
+    "    traceback.print_exception(type(e), e, e.__traceback__.tb_next)\n"
+    "    sys.exit(1)\n"
+)
+
+# Same for Node: the block runs as its own [eval] script in the global scope, so the driver's
+# locals stay hidden, and stacks are cut at the vm frame so the driver's frames never show
+_NODE_DRIVER = (
+    "(() => {\n"
+    "  let src = '';\n"
+    "  process.stdin.setEncoding('utf8');\n"
+    "  process.stdin.on('data', (chunk) => { src += chunk; });\n"
+    "  process.stdin.on('end', () => {\n"
+    "    try {\n"
+    "      require('vm').runInThisContext(src, { filename: '[eval]' });\n"
+    "    } catch (e) {\n"
+    "      if (!(e instanceof Error)) {\n"
+    "        console.error('Uncaught', e);\n"
+    "        process.exitCode = 1;\n"
+    "        return;\n"
+    "      }\n"
+    "      const lines = String(e.stack).split('\\n');\n"
+    "      const cut = lines.findIndex((line) => line.includes('(node:vm:'));\n"
+    "      if (cut > 0) e.stack = lines.slice(0, cut + 1).join('\\n');\n"
+    "      throw e;\n"
+    "    }\n"
+    "  });\n"
+    "})();\n"
+)
+
+_WARM_RUNNERS = {
+    "python": ["python", "-c", _PYTHON_DRIVER],
+    "node": ["node", "-e", _NODE_DRIVER],
+}
+
+# Code block language -> (warm runner, or None for the shell; label used in results)
+_RUNNERS = {
+    "bash": (None, None),
+    "sh": (None, None),
+    "python": ("python", "Python"),
+    "py": ("python", "Python"),
+    "javascript": ("node", "Node.js"),
+    "js": ("node", "Node.js"),
+    "node": ("node", "Node.js"),
+}
+
+# "1) ..." markers at line starts in a batched Gemini reply
+_NUMBERED_ANSWER_RE = re.compile(r'^\s*(\d+)\)\s*', re.MULTILINE)
+
+# Static command replies, built once at import
+_START_TEXT = (
+    "Hello there! I'm சாரா 👸\n\n"
+    "Your royal ASI companion who handles everything with wit and wisdom.\n"
+    "Questions, images, code, life advice - I've got you covered.\n"
+    "What can I do for you today? ✨"
+)
+
+_HELP_TEXT = """
+👸 சாரா - Your Royal ASI Assistant
+
+Who I am:
+• Your witty, wise digital companion
+• Queen of knowledge with a crown of sarcasm
+• Image whisperer, text tamer, problem crusher
+• Smarter than your average chatbot (and I know it)
+
+What I handle with royal grace:
+• ANY question or deep conversation
+• Image analysis and magical OCR
+• Code debugging and explanations
+• Creative writing and brainstorming
+• Life advice (surprisingly good quality)
+• Whatever random stuff you throw at me
+
+I'm here 24/7 to serve your digital needs with intelligence and attitude. ✨
+Send me anything - I don't judge... much. 😏
+        """
+
+@functools.lru_cache(maxsize=1024)
+def _user_prompt(first_name: str, full_name: str, username: str) -> str:
+    """Per-user part of the Saaraa prompt, rendered once per distinct name/username."""
+    user_info = {"first_name": first_name, "full_name": full_name, "username": username}
+    return f"User info: {user_info}."
+
+def _message_summary(message) -> str:
+    """Compact description of a message's content types, e.g. 'photo' or 'doc:image/png(2048B)'."""
+    parts = []
+    if message.photo:
+        parts.append("photo")
+    if message.voice:
+        parts.append("voice")
+    if message.audio:
+        parts.append(f"audio:{message.audio.mime_type}({message.audio.file_size}B,{message.audio.duration}s)")
+    if message.document:
+        parts.append(f"doc:{message.document.mime_type}({message.document.file_size}B)")
+    if message.text:
+        parts.append("text")
+    for kind in ("video", "sticker", "animation"):
+        if getattr(message, kind):
+            parts.append(kind)
+    return "+".join(parts) or "other"
+
+def _chunk_md(text: str, limit: int = 4000) -> list:
+    """Split markdown into pieces of at most limit chars at line breaks, closing and reopening ``` fences at each cut."""
+    chunks = []
+    current = ""
+    fence = None  # opening line of the ``` block we're inside, e.g. "```shell"
+    for line in text.splitlines(keepends=True):
+        is_fence = line.lstrip().startswith("```")
+        # Always leave room for the "\n```" that may close a fence at the cut
+        while len(current) + len(line) + 4 > limit:
+            reopened = fence + "\n" if fence else ""
+            # A line too long for any chunk fills the rest of this one and carries on in the next,
+            # so long output still packs full messages; other lines move whole to the next chunk
+            overlong = len(reopened) + len(line) + 4 > limit
+            room = limit - len(current) - 4 if overlong else 0
+            if room > 0:
+                current, line = current + line[:room], line[room:]
+            chunks.append(current.rstrip("\n") + ("\n```" if fence else ""))
+            current = reopened
+        current += line
+        if is_fence:
+            # Capped so a reopened fence always leaves room in the next chunk
+            fence = None if fence else line.strip()[:32]
+    if current.strip():
+        chunks.append(current.rstrip("\n") + ("\n```" if fence else ""))
+    return chunks
+
+def _format_run_result(label: str, returncode: int, stdout: bytes, stderr: bytes) -> str:
+    """Render a finished block's output, e.g. '✅ *Python executed successfully:*' plus a shell fence."""
+    if returncode == 0:
+        output = stdout.decode('utf-8', errors='replace')
+        status = f"✅ *{label} executed successfully" if label else "✅ *Executed successfully"
+        return f"{status}:*\n```shell\n{output}\n```" if output else f"{status}* (no output)"
+    error = stderr.decode('utf-8', errors='replace')
+    status = f"❌ *{label} execution failed" if label else "❌ *Execution failed"
+    return f"{status}:*\n```shell\n{error}\n```"
+
+@dataclass(frozen=True)
+class MsgCtx:
+    """Per-update message details shared by the run, group and message handlers."""
+    text: str  # text or caption, "" if neither
+    is_mention: bool  # a mention entity names the bot's @username
+
+class StreamingReply:
+    """One Telegram reply that is edited in place as Gemini streams its answer."""
+    
+    edit_interval = 1.0  # seconds between edits; Telegram allows about one edit per second per message
+    min_new_chars = 80  # don't spend an edit on a couple of extra words
+    max_send_attempts = 3  # for the final answer, waiting out RetryAfter between tries
+    
+    def __init__(self, message):
+        self.message = message
+        self.sent = None  # the bot's reply, once the first chunk arrives
+        self._shown = ""
+        self._latest = ""
+        self._last_edit = 0.0
+        self._pusher = None  # background task showing _latest
+        self._sending = False
+        self._finished = False
+    
+    def push(self, text: str):
+        """Record the partial answer so far; a background task shows it without blocking the stream."""
+        self._latest = text
+        if self._pusher is None or self._pusher.done():
+            self._pusher = asyncio.create_task(self._show_latest())
+    
+    async def _show_latest(self):
+        """Send or edit the reply with the newest partial text, throttled; partial text is plain since markdown may be unbalanced."""
+        while not self._finished and self._latest.strip() and self._latest != self._shown:
+            # The first chunk goes out at once; later ones wait for the interval and enough new text
+            if self.sent is not None and len(self._latest) - len(self._shown) < self.min_new_chars:
+                return
+            wait = self._last_edit + self.edit_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            text = self._latest
+            self._sending = True
+            try:
+                if self.sent is None:
+                    self.sent = await self.message.reply_text(text)
+                else:
+                    await self.sent.edit_text(text)
+                self._shown = text
+                self._last_edit = time.monotonic()
+            except RetryAfter as e:
+                # Hold further edits until flood control lifts; finish() catches up
+                self._last_edit = time.monotonic() + e.retry_after
+            except TelegramError as e:
+                logger.warning("⚠️ Couldn't update streamed reply: %s", e)
+                self._last_edit = time.monotonic()
+                return
+            finally:
+                self._sending = False
+    
+    async def _send(self, send, text: str, **kwargs):
+        """Make one send or edit, sleeping through Telegram's RetryAfter instead of giving up."""
+        for attempt in range(self.max_send_attempts):
+            try:
+                return await send(text, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_send_attempts - 1:
+                    raise
+                logger.warning("🚦 Telegram flood control, retrying in %ss", e.retry_after)
+                await asyncio.sleep(e.retry_after)
+    
+    async def finish(self, text: str):
+        """Show the complete answer with markdown, falling back to plain text."""
+        self._finished = True
+        if self._pusher is not None and not self._pusher.done():
+            if self._sending:
+                # Let the in-flight send land, so we edit that message rather than post a second one
+                await asyncio.wait({self._pusher})
+            else:
+                self._pusher.cancel()
+        
+        send = self.message.reply_text if self.sent is None else self.sent.edit_text
+        try:
+            await self._send(send, text, parse_mode='Markdown')
+        except TelegramError as e:
+            if "not modified" in str(e):
+                return
+            logger.warning("⚠️ Markdown failed, sending plain text: %s", e)
+            if self.sent is not None and text == self._shown:
+                return
+            await self._send(send, text)
+
 class SaaraaBot:
-    def __init__(self, bot_token: str, google_api_key: str):
+    def __init__(self, bot_token: str, google_api_key: str, run_approver_ids: set = None):
         self.bot_token = bot_token
         self.google_api_key = google_api_key
-        os.environ["GOOGLE_API_KEY"] = google_api_key
+        self._bot_username = None  # filled from context.bot on the first update
+        self._background_tasks = set()  # strong references, so pending tasks aren't garbage-collected
+        # Telegram user IDs allowed to approve running code on this host
+        self.run_approver_ids = run_approver_ids or set()
+        self.max_pending_runs = 100
+        # Approved blocks run concurrently, but never more than this many processes at once
+        self._exec_sem = asyncio.Semaphore(4)
+        self._warm_pool = {runner: asyncio.Queue() for runner in _WARM_RUNNERS}
+        self._warm_refilling = set()
+        self.warm_pool_size = 2
+        
+        # Shared HTTP client so Gemini calls reuse warm keep-alive connections
+        limits = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0)
+        self._httpx = httpx.AsyncClient(limits=limits, http2=True, timeout=httpx.Timeout(30.0, connect=5.0))
+        # The Gemini provider swaps any client that isn't an AsyncHTTPHandler (and ignores
+        # litellm.aclient_session) for its own, so wrap ours and pass it on every call
+        self._gemini_http = AsyncHTTPHandler()
+        # AsyncHTTPHandler builds its own default client (1000-connection pool); keep it until
+        # _post_init can close it on the running loop, then hand the handler ours
+        self._gemini_default_client = self._gemini_http.client
+        self._gemini_http.client = self._httpx
+        
+        # Back-pressure for bursts: callers queue here instead of starving the connection pool
+        self._gemini_sem = asyncio.Semaphore(GEMINI_MAX_INFLIGHT)
+        self._gemini_waiting = 0
+        
+        # Memory system - stores conversation per user, least recently active first
+        self.conversations = OrderedDict()  # user_id: {"messages": deque, "last_activity": time.monotonic()}
+        self.memory_timeout = 300.0  # seconds
+        self.max_users = 10_000
+        
+        # Fresh text turns (no history) arriving close together share one Gemini request
+        self._text_batch_queue = asyncio.Queue()  # (prompt, messages, future)
+        self._text_batch_task = None
+        self.text_batch_size = 8
+        self.text_batch_window = 0.075  # seconds
         
-        # Memory system - stores conversation per user
-        self.conversations = {}  # user_id: {"messages": [], "last_activity": datetime}
-        self.memory_timeout = timedelta(minutes=5)
+        # Recent media replies keyed by Telegram's content hash, so resends skip download and Gemini
+        self._media_reply_cache = OrderedDict()  # key: (reply, expires_at), least recently used first
+        self.media_cache_size = 512
+        self.media_cache_ttl = 600.0  # seconds
     
-    def get_or_reset_conversation(self, user_id: int) -> list:
-        """Get conversation history or reset if inactive for 5+ minutes."""
-        now = datetime.now()
+    def _start_conversation(self, user_id: int, now: float) -> dict:
+        """Create a fresh conversation entry, evicting expired and least recently active users."""
+        # Entries are ordered by last activity, so expired ones are all at the head
+        while self.conversations:
+            oldest = next(iter(self.conversations.values()))
+            if now - oldest["last_activity"] <= self.memory_timeout:
+                break
+            self.conversations.popitem(last=False)
         
-        if user_id not in self.conversations:
-            # New user
-            self.conversations[user_id] = {
-                "messages": [],
-                "last_activity": now
-            }
-            return []
+        self.conversations[user_id] = {
+            # Keep only last 10 messages to avoid token limits; older ones drop off on append
+            "messages": deque(maxlen=10),
+            "last_activity": now
+        }
+        self.conversations.move_to_end(user_id)
+        while len(self.conversations) > self.max_users:
+            self.conversations.popitem(last=False)
+        return self.conversations[user_id]
+    
+    def get_or_reset_conversation(self, user_id: int) -> deque:
+        """Get conversation history or reset if inactive for 5+ minutes."""
+        now = time.monotonic()
+        conversation = self.conversations.get(user_id)
         
-        # Check if conversation should be reset
-        last_activity = self.conversations[user_id]["last_activity"]
-        if now - last_activity > self.memory_timeout:
-            # Reset conversation due to inactivity
-            self.conversations[user_id] = {
-                "messages": [],
-                "last_activity": now
-            }
-            return []
+        if conversation is None or now - conversation["last_activity"] > self.memory_timeout:
+            # New user, or reset conversation due to inactivity
+            return self._start_conversation(user_id, now)["messages"]
         
         # Update last activity and return messages
-        self.conversations[user_id]["last_activity"] = now
-        return self.conversations[user_id]["messages"]
+        conversation["last_activity"] = now
+        self.conversations.move_to_end(user_id)
+        return conversation["messages"]
     
     def add_to_conversation(self, user_id: int, role: str, content: str):
         """Add a message to the conversation history."""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = {
-                "messages": [],
-                "last_activity": datetime.now()
-            }
+        now = time.monotonic()
+        conversation = self.conversations.get(user_id)
+        if conversation is None:
+            conversation = self._start_conversation(user_id, now)
         
-        self.conversations[user_id]["messages"].append({
+        conversation["messages"].append({
             "role": role,
             "content": content
         })
         
-        # Keep only last 10 messages to avoid token limits
-        if len(self.conversations[user_id]["messages"]) > 10:
-            self.conversations[user_id]["messages"] = self.conversations[user_id]["messages"][-10:]
-        
-        self.conversations[user_id]["last_activity"] = datetime.now()
+        conversation["last_activity"] = now
+        self.conversations.move_to_end(user_id)
         
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a message when the command /start is issued."""
-        await update.message.reply_text(
-            "Hello there! I'm சாரா 👸\n\n"
-            "Your royal ASI companion who handles everything with wit and wisdom.\n"
-            "Questions, images, code, life advice - I've got you covered.\n"
-            "What can I do for you today? ✨"
-        )
+        await update.message.reply_text(_START_TEXT, disable_web_page_preview=True)
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a message when the command /help is issued."""
-        help_text = """
-👸 சாரா - Your Royal ASI Assistant
-
-Who I am:
-• Your witty, wise digital companion
-• Queen of knowledge with a crown of sarcasm
-• Image whisperer, text tamer, problem crusher
-• Smarter than your average chatbot (and I know it)
+        await update.message.reply_text(_HELP_TEXT, disable_web_page_preview=True)
 
-What I handle with royal grace:
-• ANY question or deep conversation
-• Image analysis and magical OCR
-• Code debugging and explanations
-• Creative writing and brainstorming
-• Life advice (surprisingly good quality)
-• Whatever random stuff you throw at me
-
-I'm here 24/7 to serve your digital needs with intelligence and attitude. ✨
-Send me anything - I don't judge... much. 😏
-        """
-        await update.message.reply_text(help_text)
-
-    def image_to_base64(self, image_bytes: bytes) -> str:
-        """Convert image bytes to base64 string."""
-        return base64.b64encode(image_bytes).decode('utf-8')
+    async def download_as_data_url(self, file, mime_type: str) -> str:
+        """Stream a Telegram file into a base64 data URL without holding the raw bytes in memory."""
+        prefix = f"data:{mime_type};base64,".encode('ascii')
+        # Preallocate the whole URL from the reported size so appends never reallocate;
+        # slice assignment still grows the buffer if Telegram under-reported
+        encoded = bytearray(len(prefix) + 4 * -(-(file.file_size or 0) // 3))
+        encoded[:len(prefix)] = prefix
+        written = len(prefix)
+        remainder = b""
+        received = 0
+        # get_file already expanded file_path into the full api.telegram.org/file/bot<token>/... URL,
+        # so fetch it on the shared keep-alive client instead of a second PTB request
+        try:
+            async with self._httpx.stream("GET", file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    received += len(chunk)
+                    if received > MAX_MEDIA_BYTES:
+                        raise ValueError(f"File is larger than {MAX_MEDIA_BYTES} bytes")
+                    if remainder:
+                        chunk = remainder + chunk
+                    # base64 works on 3-byte groups; carry the leftover into the next chunk
+                    cut = len(chunk) - len(chunk) % 3
+                    piece = base64.b64encode(memoryview(chunk)[:cut])
+                    encoded[written:written + len(piece)] = piece
+                    written += len(piece)
+                    remainder = chunk[cut:]
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            # httpx puts the request URL in its error text, and that URL embeds the bot token;
+            # report only the status or error type so it never reaches the chat or the logs
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else type(e).__name__
+            raise ValueError(f"Couldn't download the file from Telegram ({status})") from None
+        piece = base64.b64encode(remainder)
+        encoded[written:written + len(piece)] = piece
+        written += len(piece)
+        del encoded[written:]
+        # base64 output is pure ASCII, so skip UTF-8 validation on decode
+        return encoded.decode('ascii')
     
-    def get_saaraa_prompt(self, context_type: str = "general", user_info: dict = None) -> str:
-        """Get the standard Saaraa prompt."""
-        user_context = f"User info: {user_info}. " if user_info else ""
+    def get_cached_media_reply(self, key: tuple):
+        """Return a cached reply for this media, or None if missing or expired."""
+        entry = self._media_reply_cache.get(key)
+        if entry is None:
+            return None
         
-        personality_instruction = f"{user_context}Based on the user's name, detect their likely gender and adapt your personality: If male, act like a sweet girlfriend (call them 'honey', 'baby', 'kutty' - be loving and affectionate). If female, act like a supportive sister (call them 'akka' - be warm and sisterly). If unsure, be friendly."
+        reply, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._media_reply_cache[key]
+            return None
         
-        if context_type == "image":
-            return f"You're சாரா 👸. {personality_instruction} Respond in Kongu Colloquial Tamil mixed with English. PRIORITY: If there are commands/code in the image, extract the ACTUAL EXECUTABLE COMMANDS using markdown (```bash). Don't describe - give the commands directly so they can copy-paste them. Follow KISS principle. Be direct and useful."
-        else:
-            return f"You're சாரா 👸. {personality_instruction} Respond in Kongu Colloquial Tamil mixed with English. Respond in EXACTLY ONE LINE ONLY. Follow KISS principle - Keep It Simple, Stupid! If there are commands/code, extract them using markdown (```). Be direct and useful. Consider our conversation context if relevant."
+        self._media_reply_cache.move_to_end(key)
+        return reply
     
-    async def transcribe_audio_with_gemini(self, audio_bytes: bytes, user_id: int, user_info: dict, mime_type: str = "audio/ogg") -> str:
+    def cache_media_reply(self, key: tuple, reply: str):
+        """Remember a media reply, evicting the least recently used entries over media_cache_size."""
+        self._media_reply_cache[key] = (reply, time.monotonic() + self.media_cache_ttl)
+        self._media_reply_cache.move_to_end(key)
+        while len(self._media_reply_cache) > self.media_cache_size:
+            self._media_reply_cache.popitem(last=False)
+    
+    def build_messages(self, user_info: dict, history, turn_content) -> list:
+        """Lay out a Gemini request: shared system prompt, user info, history, then this turn."""
+        messages = [{"role": "system", "content": _SAARAA_SYSTEM_PROMPT}]
+        if user_info:
+            messages.append({"role": "user", "content": _user_prompt(**user_info)})
+        messages.extend(history)
+        messages.append({"role": "user", "content": turn_content})
+        return messages
+    
+    async def transcribe_audio_with_gemini(self, audio_data_url: str, user_id: int, user_info: dict, cache_key: tuple = None) -> str:
         """Transcribe and respond to audio using Gemini directly."""
         try:
-            logger.info(f"Transcribing audio with MIME type: {mime_type}, size: {len(audio_bytes)} bytes")
-            
-            # Check file size limit (1MB for litellm compatibility)
-            if len(audio_bytes) > 5 * 1024 * 1024:
-                return "Audio file too big, கண்ணே! Keep it under 1MB for now."
-            
-            # Use data URL format that's compatible with litellm
-            audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-            data_url = f"data:{mime_type};base64,{audio_base64}"
+            logger.info("Transcribing audio: %s, %s chars", audio_data_url[:audio_data_url.index(',')], len(audio_data_url))
             
             # Use image_url format which litellm converts properly for Gemini
-            messages = [{
-                "role": "user", 
-                "content": [
-                    {"type": "text", "text": f"{self.get_saaraa_prompt('general', user_info)} Listen to this audio and transcribe"},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": data_url
-                        }
+            messages = self.build_messages(user_info, (), [
+                {"type": "text", "text": _AUDIO_TURN_TEXT},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        # Data URL format that's compatible with litellm
+                        "url": audio_data_url
                     }
-                ]
-            }]
+                }
+            ])
             
-            response = completion(
-                model="gemini/gemini-2.5-flash",
+            response = await self.gemini_completion(
                 messages=messages,
                 max_tokens=200  # Shorter response to avoid 413 errors
             )
@@ -164,94 +555,238 @@ Send me anything - I don't judge... much. 😏
             self.add_to_conversation(user_id, "user", "[Sent voice message]")
             self.add_to_conversation(user_id, "assistant", result)
             
+            if cache_key and result:
+                self.cache_media_reply(cache_key, result)
+            
             return result
             
+        except litellm.Timeout as e:
+            logger.warning("⏳ Gemini timed out transcribing audio: %s", e)
+            return _GEMINI_TIMEOUT_REPLY
+        except litellm.RateLimitError as e:
+            logger.warning("🚦 Gemini rate limit hit transcribing audio: %s", e)
+            return _GEMINI_RATE_LIMIT_REPLY
         except Exception as e:
-            logger.error(f"Error transcribing audio with Gemini: {e}")
+            logger.error("Error transcribing audio with Gemini: %s", e)
             # Fallback message
             return "Audio processing-la problem. Maybe try a shorter voice message?"
 
     async def send_with_markdown(self, update: Update, text: str):
         """Send message with markdown formatting, fallback to plain text if it fails."""
         try:
-            logger.info(f"📤 Attempting to send message with markdown")
-            await update.message.reply_text(text, parse_mode='Markdown')
-            logger.info(f"✅ Message sent successfully")
+            logger.debug("📤 Attempting to send message with markdown")
+            await update.effective_message.reply_text(text, parse_mode='Markdown')
+            logger.debug("✅ Message sent successfully")
         except Exception as e:
-            logger.warning(f"⚠️ Markdown failed, sending plain text: {e}")
+            logger.warning("⚠️ Markdown failed, sending plain text: %s", e)
             # Fallback to plain text if markdown fails
-            await update.message.reply_text(text)
-            logger.info(f"✅ Plain text message sent successfully")
+            await update.effective_message.reply_text(text)
+            logger.debug("✅ Plain text message sent successfully")
 
-    async def process_with_gemini(self, content_type: str, content, user_id: int, user_info: dict) -> str:
-        """Unified Gemini processing for all content types."""
+    async def process_with_gemini(self, content_type: str, content, user_id: int, user_info: dict, cache_key: tuple = None, reply: StreamingReply = None) -> str:
+        """Unified Gemini processing for all content types; streams into reply when given."""
         try:
-            # Get conversation history
+            # Get conversation history; this is the live deque, which add_to_conversation appends to
             conversation_history = self.get_or_reset_conversation(user_id)
-            
-            # Prepare messages with conversation context
-            messages = []
-            
-            # Add conversation history
-            if conversation_history:
-                messages.extend(conversation_history)
+            # Snapshot it now: once this turn is appended, a first message no longer looks fresh
+            is_first_turn = not conversation_history
             
             if content_type == "image":
                 # Add image message
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": f"{self.get_saaraa_prompt('image', user_info)} Analyze this image."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.image_to_base64(content)}"}}
-                    ]
-                })
-                # Add to conversation history
-                self.add_to_conversation(user_id, "user", "[Sent an image]")
+                turn_content = [
+                    {"type": "text", "text": _IMAGE_TURN_TEXT},
+                    {"type": "image_url", "image_url": {"url": content}}
+                ]
+                history_entry = "[Sent an image]"
             elif content_type == "audio":
                 # Add transcribed audio message
-                messages.append({
-                    "role": "user",
-                    "content": f"{self.get_saaraa_prompt('general', user_info)} Transcribed audio: {content}"
-                })
-                # Add to conversation history
-                self.add_to_conversation(user_id, "user", f"[Audio transcribed]: {content}")
+                turn_content = _TRANSCRIPT_TURN_PREFIX + content
+                history_entry = f"[Audio transcribed]: {content}"
             else:  # text
                 # Add text message
-                messages.append({
-                    "role": "user",
-                    "content": f"{self.get_saaraa_prompt('general', user_info)} Message: {content}"
-                })
-                # Add to conversation history
-                self.add_to_conversation(user_id, "user", content)
-            for _ in range(3):
-                response = completion(
-                    model="gemini/gemini-2.5-flash",
-                    messages=messages,
-                    max_tokens=500
-                )
-                
-                result = response.choices[0].message.content 
-                if result:
-                    break
-            else:
-                result = "No words to message."
+                turn_content = _TEXT_TURN_PREFIX + content
+                history_entry = content
+            
+            # Prepare messages with conversation context
+            messages = self.build_messages(user_info, conversation_history, turn_content)
+            # No history to carry, so this turn can be coalesced with other users' turns
+            can_batch = content_type == "text" and is_first_turn and self._text_batch_task
+            
+            # Add to conversation history
+            self.add_to_conversation(user_id, "user", history_entry)
+            
+            result = None
+            if can_batch:
+                # Only the bare turn joins a shared prompt; user info never leaves this user's request
+                result = await self._batched_text_completion(turn_content, messages)
+            
+            if not result:
+                for _ in range(3):
+                    if reply is not None:
+                        result = await self.gemini_stream(messages, reply.push, max_tokens=500)
+                    else:
+                        response = await self.gemini_completion(
+                            messages=messages,
+                            max_tokens=500
+                        )
+                        result = response.choices[0].message.content 
+                    if result:
+                        break
+                else:
+                    result = "No words to message."
+                    cache_key = None  # don't remember an empty answer
             
             # Add response to conversation history
             self.add_to_conversation(user_id, "assistant", result)
             
+            if cache_key:
+                self.cache_media_reply(cache_key, result)
+            
             return result
             
+        except litellm.Timeout as e:
+            logger.warning("⏳ Gemini timed out processing %s: %s", content_type, e)
+            return _GEMINI_TIMEOUT_REPLY
+        except litellm.RateLimitError as e:
+            logger.warning("🚦 Gemini rate limit hit processing %s: %s", content_type, e)
+            return _GEMINI_RATE_LIMIT_REPLY
         except Exception as e:
-            logger.error(f"Error processing {content_type} with Gemini: {e}")
-            logger.error(f"Full error details: {type(e).__name__}: {str(e)}")
+            logger.error("Error processing %s with Gemini: %s", content_type, e)
+            logger.error("Full error details: %s: %s", type(e).__name__, e)
             return f"Well, that didn't work. Error: {str(e)}"
 
+    async def _acquire_gemini_slot(self):
+        """Wait for one of the GEMINI_MAX_INFLIGHT request slots, logging when callers queue."""
+        if self._gemini_sem.locked():
+            self._gemini_waiting += 1
+            logger.info("⏳ Gemini concurrency limit (%s) reached, %s request(s) waiting", GEMINI_MAX_INFLIGHT, self._gemini_waiting)
+            try:
+                await self._gemini_sem.acquire()
+            finally:
+                self._gemini_waiting -= 1
+        else:
+            await self._gemini_sem.acquire()
+    
+    async def gemini_completion(self, messages: list, **kwargs):
+        """Call Gemini through litellm, capped at GEMINI_MAX_INFLIGHT concurrent requests."""
+        await self._acquire_gemini_slot()
+        try:
+            return await acompletion(
+                model="gemini/gemini-2.5-flash",
+                messages=messages,
+                api_key=self.google_api_key,
+                timeout=30,
+                num_retries=2,
+                client=self._gemini_http,
+                **kwargs
+            )
+        finally:
+            self._gemini_sem.release()
+    
+    async def gemini_stream(self, messages: list, on_text, **kwargs) -> str:
+        """Stream a Gemini completion, calling on_text with the text so far; returns the full text."""
+        # The slot is held until the stream ends, since the connection stays busy until then;
+        # on_text is a plain call (StreamingReply.push hands Telegram I/O to a task) so it never holds the slot up
+        await self._acquire_gemini_slot()
+        try:
+            response = await acompletion(
+                model="gemini/gemini-2.5-flash",
+                messages=messages,
+                api_key=self.google_api_key,
+                timeout=30,
+                num_retries=2,
+                stream=True,
+                client=self._gemini_http,
+                **kwargs
+            )
+            text = ""
+            async for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    text += delta
+                    on_text(text)
+            return text
+        finally:
+            self._gemini_sem.release()
+
+    def _spawn_background(self, coro) -> asyncio.Task:
+        """Start a task nobody awaits, keeping a reference until it finishes."""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def _batched_text_completion(self, prompt: str, messages: list) -> str:
+        """Queue a stateless text prompt for the batch worker; messages is the full request, sent if nobody else joins."""
+        future = asyncio.get_running_loop().create_future()
+        await self._text_batch_queue.put((prompt, messages, future))
+        return await future
+
+    async def _text_batch_worker(self):
+        """Drain queued text prompts in groups of up to text_batch_size within text_batch_window."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._text_batch_queue.get()]
+            deadline = loop.time() + self.text_batch_window
+            while len(batch) < self.text_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._text_batch_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self._spawn_background(self._answer_text_batch(batch))
+
+    async def _answer_text_batch(self, batch: list):
+        """Answer a batch of prompts with one Gemini call and resolve each waiting future."""
+        try:
+            if len(batch) == 1:
+                _, messages, _ = batch[0]
+                response = await self.gemini_completion(
+                    messages=messages,
+                    max_tokens=500
+                )
+                answers = [response.choices[0].message.content]
+            else:
+                numbered = "\n\n".join(f"{i}) {prompt}" for i, (prompt, _, _) in enumerate(batch, 1))
+                response = await self.gemini_completion(
+                    messages=[
+                        {"role": "system", "content": _SAARAA_SYSTEM_PROMPT},
+                        {
+                            "role": "user",
+                            "content": "These are requests from different users. Answer each numbered request "
+                                       "independently, as if it were the only one. Start each answer on a new "
+                                       "line with its number, like '1) ...'.\n\n" + numbered
+                        }
+                    ],
+                    max_tokens=500 * len(batch)
+                )
+                answers = self.split_numbered_answers(response.choices[0].message.content or "", len(batch))
+                logger.info("📦 Answered %s text messages in one Gemini call", len(batch))
+            
+            for (_, _, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def split_numbered_answers(self, text: str, count: int) -> list:
+        """Split a '1) ... 2) ...' reply into count answers; all None unless the markers are exactly 1..count."""
+        parts = _NUMBERED_ANSWER_RE.split(text)
+        # parts = [preamble, number, answer, number, answer, ...]
+        numbers = [int(number) for number in parts[1::2]]
+        if numbers != list(range(1, count + 1)):
+            # An answer with its own numbered list makes the split ambiguous; guessing could hand
+            # part of one user's answer to another, so everyone falls back to a solo request
+            return [None] * count
+        return [answer.strip() or None for answer in parts[2::2]]
+
     def extract_code_blocks(self, text: str) -> list:
         """Extract code blocks from markdown text."""
-        # Pattern to match code blocks with optional language specifier
-        # Updated to handle both newline and non-newline cases after language
-        pattern = r'```(?:(\w+)\s*)?(.*?)```'
-        matches = re.findall(pattern, text, re.DOTALL)
+        matches = _CODE_BLOCK_RE.findall(text)
         
         code_blocks = []
         for language, code in matches:
@@ -264,155 +799,238 @@ Send me anything - I don't judge... much. 😏
         
         return code_blocks
 
+    def code_blocks_from_entities(self, message) -> list:
+        """Extract code blocks from the pre entities Telegram already parsed out of a message."""
+        # parse_entities handles Telegram's UTF-16 offsets, which plain str slicing gets wrong after emoji
+        if message.text:
+            spans = message.parse_entities([MessageEntity.PRE])
+        else:
+            spans = message.parse_caption_entities([MessageEntity.PRE])
+        
+        code_blocks = []
+        for entity, code in spans.items():
+            code = code.strip()
+            if code:
+                code_blocks.append({
+                    'language': entity.language.lower() if entity.language else 'bash',
+                    'code': code
+                })
+        
+        return code_blocks
+
+    async def _spawn_warm_process(self, runner: str):
+        """Start an interpreter that waits on stdin for the code to run."""
+        return await asyncio.create_subprocess_exec(
+            *_WARM_RUNNERS[runner],
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+    async def _refill_warm_pool(self, runner: str):
+        """Top the runner's pool back up to warm_pool_size idle interpreters."""
+        if runner in self._warm_refilling:
+            return
+        self._warm_refilling.add(runner)
+        try:
+            while self._warm_pool[runner].qsize() < self.warm_pool_size:
+                self._warm_pool[runner].put_nowait(await self._spawn_warm_process(runner))
+        except OSError as e:
+            logger.warning("⚠️ Couldn't pre-start %s: %s", runner, e)
+        finally:
+            self._warm_refilling.discard(runner)
+
+    async def _take_warm_process(self, runner: str):
+        """Take an idle pre-started interpreter, or start one now if the pool is empty."""
+        pool = self._warm_pool[runner]
+        process = None
+        while process is None and not pool.empty():
+            candidate = pool.get_nowait()
+            if candidate.returncode is None:
+                process = candidate
+        if process is None:
+            process = await self._spawn_warm_process(runner)
+        self._spawn_background(self._refill_warm_pool(runner))
+        return process
+
     async def execute_code_block(self, code_block: dict) -> str:
+        """Execute a code block safely and return the result, at most 4 blocks at a time."""
+        async with self._exec_sem:
+            return await self._execute_code_block(code_block)
+
+    async def _run_with_timeout(self, process, input: bytes = None, timeout: float = 30) -> tuple:
+        """Collect a process's output, killing it if it runs past timeout instead of leaving it behind."""
+        try:
+            return await asyncio.wait_for(process.communicate(input), timeout=timeout)
+        except asyncio.TimeoutError:
+            # wait_for only cancels our wait; the child keeps running until killed and reaped
+            try:
+                # Shell blocks lead their own process group, so this also takes down what they started
+                os.killpg(process.pid, signal.SIGKILL)
+            except (AttributeError, ProcessLookupError, PermissionError):
+                process.kill()
+            await process.wait()
+            raise
+
+    async def _start_runner(self, runner: str, code: str) -> tuple:
+        """Start the process for a block; returns it with the bytes to feed it on stdin."""
+        if runner is None:
+            # Shell blocks run as the command line itself, in their own process group (see _run_with_timeout)
+            process = await asyncio.create_subprocess_shell(
+                code,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=os.getcwd(),
+                start_new_session=True
+            )
+            return process, None
+        # Python/Node blocks go to a pre-started interpreter over stdin
+        return await self._take_warm_process(runner), code.encode('utf-8')
+
+    async def _execute_code_block(self, code_block: dict) -> str:
         """Execute a code block safely and return the result."""
         try:
             language = code_block['language']
             code = code_block['code']
             
             # Security check - only allow certain languages/commands
-            if language not in ['bash', 'sh', 'python', 'py', 'javascript', 'js', 'node']:
+            if language not in _RUNNERS:
                 return f"❌ Language '{language}' not supported for execution"
             
             # Additional security - block dangerous commands
-            dangerous_patterns = [
-                r'rm\s+-rf',
-                r'sudo',
-                r'chmod\s+777',
-                r'>/dev/null',
-                r'&\s*$',
-                r'shutdown',
-                r'reboot',
-                r'format',
-                r'mkfs',
-                r'dd\s+if=',
-                r'curl.*\|.*bash',
-                r'wget.*\|.*bash'
-            ]
-            
-            for pattern in dangerous_patterns:
-                if re.search(pattern, code, re.IGNORECASE):
-                    return f"❌ Potentially dangerous command detected: {pattern}"
-            
-            # Execute based on language
-            if language in ['bash', 'sh']:
-                # Execute bash commands
-                process = await asyncio.create_subprocess_shell(
-                    code,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    cwd=os.getcwd()
-                )
-                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
-                
-                output = stdout.decode('utf-8', errors='replace')
-                error = stderr.decode('utf-8', errors='replace')
-                
-                if process.returncode == 0:
-                    return f"✅ *Executed successfully:*\n```shell\n{output}\n```" if output else "✅ *Executed successfully* (no output)"
-                else:
-                    return f"❌ *Execution failed:*\n```shell\n{error}\n```"
-                    
-            elif language in ['python', 'py']:
-                # Execute Python code
-                process = await asyncio.create_subprocess_exec(
-                    'python', '-c', code,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
-                
-                output = stdout.decode('utf-8', errors='replace')
-                error = stderr.decode('utf-8', errors='replace')
-                
-                if process.returncode == 0:
-                    return f"✅ *Python executed successfully:*\n```shell\n{output}\n```" if output else "✅ *Python executed successfully* (no output)"
-                else:
-                    return f"❌ *Python execution failed:*\n```shell\n{error}\n```"
-                    
-            elif language in ['javascript', 'js', 'node']:
-                # Execute JavaScript/Node.js code
-                process = await asyncio.create_subprocess_exec(
-                    'node', '-e', code,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
-                
-                output = stdout.decode('utf-8', errors='replace')
-                error = stderr.decode('utf-8', errors='replace')
-                
-                if process.returncode == 0:
-                    return f"✅ *Node.js executed successfully:*\n```shell\n{output}\n```" if output else "✅ *Node.js executed successfully* (no output)"
-                else:
-                    return f"❌ *Node.js execution failed:*\n```shell\n{error}\n```"
-                    
+            dangerous = _DANGEROUS_RE.search(code)
+            if dangerous:
+                return f"❌ Potentially dangerous command detected: {dangerous.group(0)}"
+            
+            runner, label = _RUNNERS[language]
+            process, stdin = await self._start_runner(runner, code)
+            stdout, stderr = await self._run_with_timeout(process, stdin)
+            return _format_run_result(label, process.returncode, stdout, stderr)
+            
         except asyncio.TimeoutError:
             return "❌ *Execution timed out* (30 second limit)"
         except Exception as e:
             return f"❌ *Execution error:* {str(e)}"
 
+    def message_context(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> MsgCtx:
+        """Read the message text and mention check once per update."""
+        if self._bot_username is None:
+            self._bot_username = context.bot.username
+        message = update.message
+        text = message.text or message.caption or ""
+        # Telegram already marked every @username; most group messages have none, so no text scan at all
+        if message.text:
+            entities, parse = message.entities, message.parse_entity
+        else:
+            entities, parse = message.caption_entities, message.parse_caption_entity
+        handle = f"@{self._bot_username}".lower()
+        is_mention = any(
+            entity.type == MessageEntity.MENTION and entity.length == len(handle) and parse(entity).lower() == handle
+            for entity in entities or ()
+        )
+        return MsgCtx(text, is_mention)
+
     async def handle_run_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle @SaraTheQueenBot run command in group chats."""
         try:
-            message_text = update.message.text or update.message.caption or ""
+            msg_ctx = self.message_context(update, context)
+            message_text = msg_ctx.text
             lower_message_text = message_text.lower()
             has_run_command = "run" in lower_message_text or 'test' in lower_message_text
             
             # Check if this is a mention with "run" command
-            bot_username = context.bot.username
-            if f"@{bot_username}" in message_text:
+            if msg_ctx.is_mention:
                 if not has_run_command:
-                    return await self.handle_message(update, context)
+                    return await self.handle_message(update, context, msg_ctx)
             else:
                 return
             
             user = update.effective_user
-            logger.info(f"🏃 Run command from {user.first_name} in chat {update.effective_chat.id}")
+            logger.info("🏃 Run command from %s in chat %s", user.first_name, update.effective_chat.id)
             
-            # Show typing indicator
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            if not self.run_approver_ids:
+                await update.message.reply_text("Code execution is disabled. Set RUN_APPROVER_IDS to enable it.")
+                return
             
             # Extract code blocks from reply message if available, otherwise from current message
-            if update.message.reply_to_message:
-                reply_text = update.message.reply_to_message.text_markdown_v2  or update.message.reply_to_message.caption or ""
-                logger.info(f"🔍 Extracting code blocks from reply message: {reply_text}")
-                code_blocks = self.extract_code_blocks(reply_text)
+            reply = update.message.reply_to_message
+            if reply:
+                logger.info("🔍 Extracting code blocks from reply message: %s", reply.text or reply.caption)
+                # Formatted ``` blocks arrive as pre entities; fall back to the regex for literal backticks
+                code_blocks = self.code_blocks_from_entities(reply) or self.extract_code_blocks(reply.text or reply.caption or "")
             else:
-                logger.info(f"🔍 Extracting code blocks from current message: {message_text}")
+                logger.info("🔍 Extracting code blocks from current message: %s", message_text)
                 code_blocks = self.extract_code_blocks(message_text)
             
             if not code_blocks:
                 await update.message.reply_text("No code blocks found to execute! Use ```bash or ```python format.")
                 return
             
-            confirmation = prompt("Are you sure you want to execute these code blocks? (y/n)")
-            if confirmation.lower() != "y":
-                await update.message.reply_text("Code execution cancelled!")
-                return
+            # Park the blocks until an approver answers the inline keyboard (see on_run_confirm)
+            pending = context.bot_data.setdefault("pending_runs", {})
+            token = secrets.token_urlsafe(8)
+            pending[token] = code_blocks
+            while len(pending) > self.max_pending_runs:
+                pending.pop(next(iter(pending)))
+            
+            keyboard = InlineKeyboardMarkup([[
+                InlineKeyboardButton("✅ Run", callback_data=f"run:{token}"),
+                InlineKeyboardButton("❌ Cancel", callback_data=f"cancel:{token}")
+            ]])
+            await update.message.reply_text(
+                f"Are you sure you want to execute {len(code_blocks)} code block(s)? Waiting for an approver.",
+                reply_markup=keyboard
+            )
+                
+        except Exception as e:
+            logger.error("Error handling run command: %s", e)
+            await update.message.reply_text(f"Error executing code: {str(e)}")
+
+    async def on_run_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Run or cancel parked code blocks once an approver presses the inline keyboard."""
+        query = update.callback_query
+        action, token = query.data.split(":", 1)
+        
+        if query.from_user.id not in self.run_approver_ids:
+            await query.answer("Only the bot owner can approve code execution.", show_alert=True)
+            return
+        
+        await query.answer()
+        code_blocks = context.bot_data.get("pending_runs", {}).pop(token, None)
+        if code_blocks is None:
+            await query.edit_message_text("This run request has expired.")
+            return
+        if action == "cancel":
+            await query.edit_message_text("Code execution cancelled!")
+            return
+        
+        logger.info("✅ Run approved by %s", query.from_user.first_name)
+        await query.edit_message_text(f"Running {len(code_blocks)} code block(s)... 🏃")
+        
+        try:
+            # Show typing indicator
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
             
-            # Execute each code block
+            # Execute the blocks concurrently; gather keeps results in block order
+            outputs = await asyncio.gather(*(self.execute_code_block(cb) for cb in code_blocks), return_exceptions=True)
             results = []
-            for i, code_block in enumerate(code_blocks):
-                result = await self.execute_code_block(code_block)
+            for i, (code_block, result) in enumerate(zip(code_blocks, outputs)):
+                if isinstance(result, Exception):
+                    result = f"❌ *Execution error:* {str(result)}"
                 results.append(f"*Block {i+1} ({code_block['language']}):*\n{result}")
             
             # Send results
             final_result = "\n\n".join(results)
             
-            # Split long messages
-            if len(final_result) > 4000:
-                parts = [final_result[i:i+4000] for i in range(0, len(final_result), 4000)]
-                for part in parts:
-                    await self.send_with_markdown(update, part)
-            else:
-                await self.send_with_markdown(update, final_result)
+            # Split long messages without leaving a ``` block open in any part
+            for part in _chunk_md(final_result):
+                await self.send_with_markdown(update, part)
                 
         except Exception as e:
-            logger.error(f"Error handling run command: {e}")
-            await update.message.reply_text(f"Error executing code: {str(e)}")
+            logger.error("Error running approved code: %s", e)
+            await update.effective_message.reply_text(f"Error executing code: {str(e)}")
 
-    def should_respond_in_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    def should_respond_in_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE, msg_ctx: MsgCtx) -> bool:
         """Check if bot should respond in group chat (only if mentioned or replying to bot)."""
         # Always respond in private chats
         if update.effective_chat.type == "private":
@@ -422,11 +1040,8 @@ Send me anything - I don't judge... much. 😏
         # 1. Bot is mentioned
         # 2. Message is a reply to bot's message
         
-        bot_username = context.bot.username
-        message_text = update.message.text or update.message.caption or ""
-        
         # Check if bot is mentioned
-        if f"@{bot_username}" in message_text:
+        if msg_ctx.is_mention:
             return True
         
         # Check if message is a reply to bot's message
@@ -438,137 +1053,204 @@ Send me anything - I don't judge... much. 😏
         
         return False
     
-    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Unified message handler for all content types."""
+    async def reject_oversized(self, update: Update, file_size) -> bool:
+        """Reply and return True if Telegram reports the file as larger than MAX_MEDIA_BYTES."""
+        if file_size and file_size > MAX_MEDIA_BYTES:
+            logger.info("🚫 Rejecting %s byte file before download", file_size)
+            await update.message.reply_text("File too big, கண்ணே! Keep it under 5MB for now.")
+            return True
+        return False
+
+    def user_info_for(self, user) -> dict:
+        """Collect the user details Saaraa's prompt personalises on."""
+        full_name = user.first_name
+        if user.last_name:
+            full_name += f" {user.last_name}"
+        
+        return {
+            "first_name": user.first_name,
+            "full_name": full_name,
+            "username": user.username
+        }
+
+    async def keep_typing(self, bot, chat_id: int):
+        """Send the typing action every 4 seconds until cancelled; Telegram clears it after 5."""
+        while True:
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action="typing")
+            except TelegramError as e:
+                logger.warning("⚠️ Couldn't send typing action: %s", e)
+            await asyncio.sleep(4)
+
+    async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, msg_ctx: MsgCtx = None):
+        """Unified message handler for all content types; msg_ctx is passed on by handle_run_command."""
+        message = update.message
+        # Fast path: edits carry no message, and commands belong to the CommandHandlers
+        if message is None or (message.text and message.text.startswith('/')):
+            return
+        
         try:
-            logger.info(f"🎯 HANDLE_MESSAGE CALLED!")
+            logger.debug("🎯 HANDLE_MESSAGE CALLED!")
             
             user_id = update.effective_user.id
             user = update.effective_user
             
             # Check if we should respond in group chats
-            if not self.should_respond_in_group(update, context):
-                logger.info(f"🚫 Ignoring group message (not mentioned or reply)")
+            if msg_ctx is None:
+                msg_ctx = self.message_context(update, context)
+            if not self.should_respond_in_group(update, context, msg_ctx):
+                logger.debug("🚫 Ignoring group message (not mentioned or reply)")
                 return
             
-            # Comprehensive logging
-            logger.info(f"=== NEW MESSAGE FROM {user.first_name} ===")
-            logger.info(f"Message has photo: {bool(update.message.photo)}")
-            logger.info(f"Message has document: {bool(update.message.document)}")
-            logger.info(f"Message has voice: {bool(update.message.voice)}")
-            logger.info(f"Message has audio: {bool(update.message.audio)}")
-            logger.info(f"Message has text: {bool(update.message.text)}")
-            
-            if update.message.text:
-                logger.info(f"Text content: {update.message.text}")
-            
-            if update.message.document:
-                logger.info(f"Document filename: {update.message.document.file_name}")
-                logger.info(f"Document MIME type: {update.message.document.mime_type}")
-                logger.info(f"Document size: {update.message.document.file_size}")
-            
-            if update.message.audio:
-                logger.info(f"Audio filename: {update.message.audio.file_name}")
-                logger.info(f"Audio MIME type: {update.message.audio.mime_type}")
-                logger.info(f"Audio duration: {update.message.audio.duration}s")
-                logger.info(f"Audio size: {update.message.audio.file_size}")
-            
-            # Collect user info
-            full_name = user.first_name
-            if user.last_name:
-                full_name += f" {user.last_name}"
-            
-            user_info = {
-                "first_name": user.first_name,
-                "full_name": full_name,
-                "username": user.username
-            }
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("msg user=%s types=%s text=%r", user.first_name, _message_summary(message), message.text)
             
-            # Show typing indicator
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+            document = message.document
+            document_mime = (document.mime_type or "") if document else ""
             
-            result = None
-            
-            # Handle different message types
-            if update.message.photo:
-                # Handle photo
-                logger.info("🖼️ Processing photo message")
-                photo = update.message.photo[-1]
-                file = await context.bot.get_file(photo.file_id)
-                image_bytes = await file.download_as_bytearray()
-                result = await self.process_with_gemini("image", bytes(image_bytes), user_id, user_info)
+            # Work out what we are handling before doing any network I/O
+            media = None  # Telegram file (PhotoSize/Document/Voice/Audio) to download
+            mime_type = "image/jpeg"  # images are always sent to Gemini as JPEG
+            if message.photo:
+                logger.debug("🖼️ Processing photo message")
+                content_type, media = "image", message.photo[-1]
                 
-            elif update.message.document and update.message.document.mime_type and update.message.document.mime_type.startswith('image/'):
-                # Handle image document
-                logger.info("🖼️ Processing image document")
-                file = await context.bot.get_file(update.message.document.file_id)
-                image_bytes = await file.download_as_bytearray()
-                result = await self.process_with_gemini("image", bytes(image_bytes), user_id, user_info)
+            elif document_mime.startswith('image/'):
+                logger.debug("🖼️ Processing image document")
+                content_type, media = "image", document
                 
-            elif update.message.text and not update.message.text.startswith('/'):
-                # Handle text (skip commands)
-                logger.info("💬 Processing text message")
-                result = await self.process_with_gemini("text", update.message.text, user_id, user_info)
+            elif message.text:
+                logger.debug("💬 Processing text message")
+                content_type = "text"
                 
-            elif update.message.voice:
-                # Handle voice messages
-                logger.info("🎙️ Processing voice message")
-                file = await context.bot.get_file(update.message.voice.file_id)
-                audio_bytes = await file.download_as_bytearray()
-                result = await self.transcribe_audio_with_gemini(bytes(audio_bytes), user_id, user_info, "audio/ogg")
+            elif message.voice:
+                logger.debug("🎙️ Processing voice message")
+                content_type, media, mime_type = "audio", message.voice, "audio/ogg"
                 
-            elif update.message.audio:
-                # Handle audio messages (audio files sent as audio, not documents)
-                logger.info(f"🎵 Processing audio message: {update.message.audio.file_name}, duration: {update.message.audio.duration}s")
-                file = await context.bot.get_file(update.message.audio.file_id)
-                audio_bytes = await file.download_as_bytearray()
-                result = await self.transcribe_audio_with_gemini(bytes(audio_bytes), user_id, user_info, update.message.audio.mime_type or "audio/mp4")
+            elif message.audio:
+                # Audio files sent as audio, not documents
+                logger.debug("🎵 Processing audio message: %s, duration: %ss", message.audio.file_name, message.audio.duration)
+                content_type, media, mime_type = "audio", message.audio, message.audio.mime_type or "audio/mp4"
                 
-            elif update.message.document and update.message.document.mime_type and update.message.document.mime_type.startswith('audio/'):
-                # Handle audio documents (m4a, mp3, wav, etc.)
-                logger.info(f"🎵 Processing audio document: {update.message.document.file_name}, MIME: {update.message.document.mime_type}")
-                file = await context.bot.get_file(update.message.document.file_id)
-                audio_bytes = await file.download_as_bytearray()
-                result = await self.transcribe_audio_with_gemini(bytes(audio_bytes), user_id, user_info, update.message.document.mime_type)
+            elif document_mime.startswith('audio/'):
+                # Audio documents (m4a, mp3, wav, etc.)
+                logger.debug("🎵 Processing audio document: %s, MIME: %s", document.file_name, document_mime)
+                content_type, media, mime_type = "audio", document, document_mime
                 
-            elif update.message.document:
-                logger.info("📄 Processing other document")
-                result = "That's not an image."
+            elif document:
+                logger.debug("📄 Processing other document")
+                await self.send_with_markdown(update, "That's not an image.")
+                return
             
             else:
                 logger.info("❓ No handler found for this message type")
+                return
+            
+            if media is not None and await self.reject_oversized(update, media.file_size):
+                return
             
+            # A resend/forward of media we just answered for this user gets the same reply
+            cache_key = (media.file_unique_id, content_type, PROMPT_VERSION, user_id) if media is not None else None
+            result = self.get_cached_media_reply(cache_key) if cache_key else None
             if result:
-                logger.info(f"✅ Sending response: {result[:100]}...")
+                logger.debug("♻️ Reusing cached reply for %s", media.file_unique_id)
+                self.add_to_conversation(user_id, "user", "[Sent an image]" if content_type == "image" else "[Sent voice message]")
+                self.add_to_conversation(user_id, "assistant", result)
                 await self.send_with_markdown(update, result)
+                return
+            
+            user_info = self.user_info_for(user)
+            reply = StreamingReply(message)
+            
+            # Show typing indicator alongside the download and Gemini call rather than before them
+            typing_task = asyncio.create_task(self.keep_typing(context.bot, update.effective_chat.id))
+            try:
+                if content_type == "text":
+                    result = await self.process_with_gemini("text", message.text, user_id, user_info, reply=reply)
+                else:
+                    file = await context.bot.get_file(media.file_id)
+                    # Some photo sizes arrive without file_size; get_file always reports it
+                    if await self.reject_oversized(update, file.file_size):
+                        return
+                    data_url = await self.download_as_data_url(file, mime_type)
+                    if content_type == "image":
+                        result = await self.process_with_gemini("image", data_url, user_id, user_info, cache_key, reply)
+                    else:
+                        result = await self.transcribe_audio_with_gemini(data_url, user_id, user_info, cache_key)
+            finally:
+                typing_task.cancel()
+            
+            if result:
+                logger.debug("✅ Sending response: %s...", result[:100])
+                await reply.finish(result)
             else:
                 logger.warning("❌ No result generated for message")
             
         except Exception as e:
-            logger.error(f"Error handling message: {e}")
-            logger.error(f"Full error details: {type(e).__name__}: {str(e)}")
-            await update.message.reply_text(f"Something broke. {str(e)}")
+            logger.error("Error handling message: %s", e)
+            logger.error("Full error details: %s: %s", type(e).__name__, e)
+            await message.reply_text(f"Something broke. {str(e)}")
 
     async def debug_unhandled_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Debug handler to catch messages not handled by main handler."""
-        logger.warning(f"🚨 UNHANDLED MESSAGE TYPE from {update.effective_user.first_name}")
-        logger.warning(f"Message type details:")
-        logger.warning(f"  - Photo: {bool(update.message.photo)}")
-        logger.warning(f"  - Document: {bool(update.message.document)}")
-        logger.warning(f"  - Voice: {bool(update.message.voice)}")
-        logger.warning(f"  - Audio: {bool(update.message.audio)}")
-        logger.warning(f"  - Video: {bool(update.message.video)}")
-        logger.warning(f"  - Text: {bool(update.message.text)}")
-        logger.warning(f"  - Sticker: {bool(update.message.sticker)}")
-        logger.warning(f"  - Animation: {bool(update.message.animation)}")
-        if update.message.document:
-            logger.warning(f"  - Document MIME: {update.message.document.mime_type}")
-            logger.warning(f"  - Document name: {update.message.document.file_name}")
+        message = update.effective_message
+        if message is None:
+            return
+        # One line per update; the summary already carries document MIME type and size
+        logger.debug("🚨 UNHANDLED MESSAGE from %s: %s%s", update.effective_user.first_name, _message_summary(message),
+                     f" name={message.document.file_name!r}" if message.document else "")
+
+    async def _post_init(self, application: Application):
+        """Prepare shared resources once the polling event loop is running."""
+        if self._gemini_default_client is not None:
+            # Never used for a request, so this only releases its (empty) pool
+            await self._gemini_default_client.aclose()
+            self._gemini_default_client = None
+        await self._prewarm(application)
+        if TEXT_BATCHING:
+            self._text_batch_task = asyncio.create_task(self._text_batch_worker())
+        if self.run_approver_ids:
+            for runner in _WARM_RUNNERS:
+                self._spawn_background(self._refill_warm_pool(runner))
+
+    async def _post_shutdown(self, application: Application):
+        """Stop background tasks and idle interpreters started in _post_init and close the shared HTTP client."""
+        if self._text_batch_task:
+            self._text_batch_task.cancel()
+        for pool in self._warm_pool.values():
+            while not pool.empty():
+                process = pool.get_nowait()
+                if process.returncode is None:
+                    process.kill()
+        await self._httpx.aclose()
+
+    async def _prewarm(self, application: Application):
+        """Open a TLS connection to Gemini before the first user message arrives."""
+        try:
+            # Gemini calls go through self._httpx (via self._gemini_http), and the pool keeps
+            # connections per origin, so the first completion reuses this warm HTTP/2 connection
+            # without spending a token-billed request at startup
+            await self._httpx.get("https://generativelanguage.googleapis.com/")
+            logger.info("🔥 Gemini connection pre-warmed")
+        except httpx.HTTPError as e:
+            logger.warning("⚠️ Gemini pre-warm failed: %s", e)
 
     def run(self):
         """Start the bot."""
-        # Create application
-        application = Application.builder().token(self.bot_token).build()
+        # Create application; startup hooks run on the polling event loop so the
+        # pre-warmed connection stays usable by the shared client
+        # Bot API requests (replies, typing actions, get_file) share a larger HTTP/2 pool;
+        # long polling gets its own client so it never queues behind them
+        request = HTTPXRequest(connection_pool_size=64, connect_timeout=5, read_timeout=20, http_version="2")
+        application = (
+            Application.builder()
+            .token(self.bot_token)
+            .request(request)
+            .get_updates_request(HTTPXRequest(connection_pool_size=8))
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
 
         # Add handlers
         application.add_handler(CommandHandler("start", self.start))
@@ -576,12 +1258,15 @@ Send me anything - I don't judge... much. 😏
         
         # Add run command handler for group chats (mentions with "run")
         application.add_handler(MessageHandler(filters.TEXT & filters.Entity("mention"), self.handle_run_command))
+        application.add_handler(CallbackQueryHandler(self.on_run_confirm, pattern=r"^(run|cancel):"))
         
         # Main message handler - simplified to catch all messages
         application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, self.handle_message))
         
-        # Catch-all handler for debugging
-        application.add_handler(MessageHandler(filters.ALL, self.debug_unhandled_message))
+        # Catch-all handler for debugging; stays in the default group so it
+        # only fires for updates no handler above consumed
+        if logger.isEnabledFor(logging.DEBUG):
+            application.add_handler(MessageHandler(filters.ALL, self.debug_unhandled_message))
 
         # Start polling
         logger.info("Starting bot...")
@@ -592,14 +1277,18 @@ def main():
     # Load environment variables
     bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
     google_api_key = os.getenv("GOOGLE_API_KEY")
+    run_approver_ids = {int(user_id) for user_id in os.getenv("RUN_APPROVER_IDS", "").split(",") if user_id.strip()}
     
     if not bot_token:
         raise ValueError("TELEGRAM_BOT_TOKEN environment variable is required")
     if not google_api_key:
         raise ValueError("GOOGLE_API_KEY environment variable is required")
+    if GEMINI_MAX_INFLIGHT < 1:
+        # Semaphore(0) would make every Gemini call wait forever without an error
+        raise ValueError(f"LLM_INFLIGHT_LIMIT must be at least 1, got {GEMINI_MAX_INFLIGHT}")
     
     # Create and run bot
-    bot = SaaraaBot(bot_token, google_api_key)
+    bot = SaaraaBot(bot_token, google_api_key, run_approver_ids)
     bot.run()
 
 if __name__ == "__main__":